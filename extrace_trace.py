@@ -1,77 +1,276 @@
+import array
+import heapq
 import json
 import gzip
-from collections import defaultdict
+import operator
+import os
+import sys
 
-def analyze_kernel_events(trace_file):
+# rapidgzip 支持多线程分块解压，大trace文件解压速度近似随核数线性提升
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+
+# orjson 的解析速度通常是标准库 json 的 2-5 倍，没装时退回标准库
+try:
+    import orjson as _json
+except ImportError:
+    _json = json
+
+# numba 可把纯数值的累加循环编译成机器码（冷启动JIT成本用cache=True摊薄）
+try:
+    import numba
+    import numpy as np
+except ImportError:
+    numba = None
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _accumulate_batch(idxs, durs, n, batch_totals, batch_counts):
+        """把一批 (下标, 耗时) 以机器码速度累加进平铺数组"""
+        for i in range(n):
+            idx = idxs[i]
+            batch_totals[idx] += durs[i]
+            batch_counts[idx] += 1
+
+# 优先使用 C 加速的 yajl2 后端（纯 Python 后端解析大文件非常慢）
+try:
+    import ijson.backends.yajl2_c as ijson
+except ImportError:
+    try:
+        import ijson
+    except ImportError:
+        ijson = None
+
+
+def _iter_kernel_event_candidates(f):
+    """用 ijson.parse 的底层事件流在 tokenizer 层过滤kernel事件
+
+    一旦读到 cat != "kernel"（trace 里通常 60-80% 是 python_function），
+    立即丢弃该事件的剩余键值，完全不为它构建事件dict；
+    只有kernel事件才物化出含 cat/name/dur 的小字典。
+    """
+    current = None   # 当前累积中的事件字段
+    skip = False     # 当前事件已确认非kernel
+
+    for prefix, event, value in ijson.parse(f):
+        if prefix == "traceEvents.item":
+            if event == "start_map":
+                current = {}
+                skip = False
+            elif event == "end_map":
+                if current is not None and not skip:
+                    yield current
+                current = None
+        elif skip or current is None:
+            continue
+        elif prefix == "traceEvents.item.cat":
+            if value != "kernel":
+                skip = True
+            else:
+                current["cat"] = value
+        elif prefix == "traceEvents.item.name":
+            current["name"] = value
+        elif prefix == "traceEvents.item.dur":
+            # ijson 把小数解析成 Decimal，统一转成 float 再参与累加
+            current["dur"] = value if isinstance(value, int) else float(value)
+
+
+def _iter_trace_events(f):
+    """流式迭代 traceEvents 数组中的事件
+
+    有 ijson 时边解析边产出事件，且非kernel事件在 tokenizer 层就被
+    丢弃、不会构建成dict；没有 ijson 时退回 json.load 整体加载。
+    """
+    if ijson is not None:
+        yield from _iter_kernel_event_candidates(f)
+        return
+
+    # orjson 只接受 bytes，因此文件统一以二进制方式打开整体读入
+    trace_data = _json.loads(f.read())
+
+    # 检查是否包含traceEvents字段
+    if "traceEvents" not in trace_data:
+        print("错误：文件中未找到'traceEvents'字段")
+        return
+
+    yield from trace_data["traceEvents"]
+
+
+def _fadvise_sequential(fileobj):
+    """提示内核该文件将被一次性顺序读取，可以激进预读（仅Linux生效）"""
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fileobj.fileno(), 0, 0,
+                             os.POSIX_FADV_SEQUENTIAL | os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+
+
+def _fadvise_dontneed(fileobj):
+    """读完后提示内核释放该文件占用的页缓存，留给后续任务"""
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fileobj.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+
+
+def _wrap_gzip(raw):
+    """把已打开的 .gz 文件对象包装成解压后的二进制流
+
+    优先使用 rapidgzip 做多线程并行解压，未安装时退回单线程的标准库 gzip。
+    """
+    if rapidgzip is not None:
+        return rapidgzip.open(raw, parallelization=os.cpu_count())
+    return gzip.GzipFile(fileobj=raw)
+
+
+def _accumulate_kernel_stats(events, name_to_idx, totals, counts):
+    """遍历事件流，把kernel事件累加到平铺数组中
+
+    统计数据按 SoA（结构数组）布局存放：name_to_idx 把kernel名称映射到
+    下标，totals/counts 是按下标对齐的平铺数组。相比每个kernel一个内层
+    dict，每个事件只需一次哈希查找，新kernel也不再分配小字典。
+    """
+    if numba is not None:
+        _accumulate_kernel_stats_batched(events, name_to_idx, totals, counts)
+        return
+
+    # 把热循环里用到的方法绑定为局部变量，省去每次迭代的属性查找
+    get_idx = name_to_idx.get
+    append_total = totals.append
+    append_count = counts.append
+    intern = sys.intern
+
+    for event in events:
+        # EAFP：直接取三个字段，非dict事件或缺字段的事件统一走异常路径跳过
+        try:
+            if event["cat"] != "kernel":
+                continue
+            # JSON解析出的kernel名称每次都是新str对象，而CUDA mangled名称
+            # 动辄上百字节且重复数百万次；intern 让重复名称共享同一对象
+            kernel_name = intern(event["name"])
+            duration = event["dur"]
+        except (KeyError, TypeError):
+            continue
+
+        if not isinstance(duration, (int, float)):
+            continue  # 跳过耗时不是数值的事件
+
+        # 更新统计数据
+        idx = get_idx(kernel_name)
+        if idx is None:
+            idx = len(totals)
+            name_to_idx[kernel_name] = idx
+            append_total(0.0)
+            append_count(0)
+        totals[idx] += duration
+        counts[idx] += 1
+
+
+_BATCH_SIZE = 65536
+
+
+def _accumulate_kernel_stats_batched(events, name_to_idx, totals, counts):
+    """numba 加速路径：按批收集耗时，数值累加交给njit编译的归并循环
+
+    名称→下标映射仍在 Python 侧完成（需要 intern 和 dict），每攒满一批
+    (下标, 耗时) 就调用一次机器码级的 _accumulate_batch。累加用 numpy
+    数组按倍数扩容，最后一次性拷回调用方的平铺数组。
+    """
+    np_totals = np.zeros(1024, dtype=np.float64)
+    np_counts = np.zeros(1024, dtype=np.int64)
+    idx_buf = np.empty(_BATCH_SIZE, dtype=np.int64)
+    dur_buf = np.empty(_BATCH_SIZE, dtype=np.float64)
+    n = 0
+
+    get_idx = name_to_idx.get
+    intern = sys.intern
+
+    for event in events:
+        try:
+            if event["cat"] != "kernel":
+                continue
+            kernel_name = intern(event["name"])
+            duration = event["dur"]
+        except (KeyError, TypeError):
+            continue
+
+        if not isinstance(duration, (int, float)):
+            continue  # 跳过耗时不是数值的事件
+
+        idx = get_idx(kernel_name)
+        if idx is None:
+            idx = len(name_to_idx)
+            name_to_idx[kernel_name] = idx
+            if idx >= np_totals.shape[0]:
+                # 倍数扩容，摊还成本为 O(1)
+                np_totals = np.concatenate([np_totals, np.zeros_like(np_totals)])
+                np_counts = np.concatenate([np_counts, np.zeros_like(np_counts)])
+
+        idx_buf[n] = idx
+        dur_buf[n] = duration
+        n += 1
+        if n == _BATCH_SIZE:
+            _accumulate_batch(idx_buf, dur_buf, n, np_totals, np_counts)
+            n = 0
+
+    if n:
+        _accumulate_batch(idx_buf, dur_buf, n, np_totals, np_counts)
+
+    unique = len(name_to_idx)
+    totals.extend(np_totals[:unique])
+    counts.extend(np_counts[:unique].tolist())
+
+
+def analyze_kernel_events(trace_file, top_k=None):
     """
     解析JSON trace文件，统计cat为"kernel"的事件中每个kernel的执行时间
-    
+
     参数:
         trace_file: JSON trace文件路径
+        top_k: 只返回总耗时最高的前k个kernel（None表示全部返回）
     返回:
         按总耗时降序排序的kernel统计列表
     """
-    # 用字典存储每个kernel的统计数据
-    kernel_stats = defaultdict(lambda: {
-        "total_duration_us": 0.0,  # 总耗时（微秒）
-        "count": 0,                # 执行次数
-        "avg_duration_us": 0.0     # 平均耗时（微秒）
-    })
+    # SoA布局的统计数据：名称→下标映射 + 两个平铺数组
+    name_to_idx = {}
+    totals = array.array("d")   # 总耗时（微秒）
+    counts = array.array("q")   # 执行次数
 
     try:
-        # 加载JSON文件
+        # 打开trace文件，逐事件流式解析（不构建完整的trace_data字典）；
+        # trace只顺序读一遍，用 fadvise 提示内核预读、读完释放页缓存
         if trace_file.endswith("gz"):
-            with gzip.open(trace_file, "rt", encoding="utf-8") as f:
-                # 先解压得到文件对象，再用 json.load 解析
-                trace_data = json.load(f)
+            with open(trace_file, 'rb') as raw:
+                _fadvise_sequential(raw)
+                with _wrap_gzip(raw) as f:
+                    _accumulate_kernel_stats(_iter_trace_events(f), name_to_idx, totals, counts)
+                _fadvise_dontneed(raw)
         else:
-            with open(trace_file, 'r', encoding='utf-8') as f:
-                trace_data = json.load(f)
-
-        # 检查是否包含traceEvents字段
-        if "traceEvents" not in trace_data:
-            print("错误：文件中未找到'traceEvents'字段")
-            return []
-
-        # 遍历所有事件
-        for event in trace_data["traceEvents"]:
-            # 筛选条件1：事件类别为"kernel"
-            if event.get("cat") != "kernel":
-                continue
+            with open(trace_file, 'rb') as f:
+                _fadvise_sequential(f)
+                _accumulate_kernel_stats(_iter_trace_events(f), name_to_idx, totals, counts)
+                _fadvise_dontneed(f)
 
-            # 严格验证事件格式（避免类型错误）
-            # 确保事件是字典类型，且包含必要字段
-            if not isinstance(event, dict):
-                continue  # 跳过非对象类型的事件
-            if "name" not in event or not isinstance(event["name"], str):
-                continue  # 跳过缺少kernel名称或名称不是字符串的事件
-            if "dur" not in event or not isinstance(event["dur"], (int, float)):
-                continue  # 跳过缺少耗时或耗时不是数值的事件
-
-            # 提取kernel名称和耗时
-            kernel_name = event["name"]
-            duration = event["dur"]
+        # 先用元组排序（比dict轻量），itemgetter 是C实现、比lambda快数倍
+        items = [(kernel, totals[idx], counts[idx])
+                 for kernel, idx in name_to_idx.items() if counts[idx] > 0]
+        if top_k is not None:
+            # 只要前k名时用堆选择，免去整体排序
+            items = heapq.nlargest(top_k, items, key=operator.itemgetter(1))
+        else:
+            items.sort(key=operator.itemgetter(1), reverse=True)
 
-            # 更新统计数据
-            kernel_stats[kernel_name]["total_duration_us"] += duration
-            kernel_stats[kernel_name]["count"] += 1
-
-        # 计算平均耗时并整理结果
-        result = []
-        for kernel, stats in kernel_stats.items():
-            if stats["count"] > 0:
-                stats["avg_duration_us"] = round(
-                    stats["total_duration_us"] / stats["count"], 3
-                )
-                result.append({
-                    "kernel": kernel,
-                    "total_duration_us": round(stats["total_duration_us"], 3),
-                    "count": stats["count"],
-                    "avg_duration_us": stats["avg_duration_us"]
-                })
-
-        # 按总耗时降序排序
-        return sorted(result, key=lambda x: x["total_duration_us"], reverse=True)
+        # 最后一步才物化成dict，计算平均耗时
+        return [{
+            "kernel": kernel,
+            "total_duration_us": round(total, 3),
+            "count": count,
+            "avg_duration_us": round(total / count, 3)
+        } for kernel, total, count in items]
 
     except FileNotFoundError:
         print(f"错误：文件 '{trace_file}' 不存在")
@@ -83,17 +282,58 @@ def analyze_kernel_events(trace_file):
         print(f"处理错误：{str(e)}")
         return []
 
+def merge_kernel_stats(partials):
+    """归并多个 analyze_kernel_events 的结果（多文件/多rank场景）
+
+    参数:
+        partials: 每个文件的统计列表组成的列表
+    返回:
+        按总耗时降序排序的合并后统计列表
+    """
+    name_to_idx = {}
+    totals = array.array("d")
+    counts = array.array("q")
+
+    for part in partials:
+        for item in part:
+            idx = name_to_idx.get(item["kernel"])
+            if idx is None:
+                idx = len(totals)
+                name_to_idx[item["kernel"]] = idx
+                totals.append(0.0)
+                counts.append(0)
+            totals[idx] += item["total_duration_us"]
+            counts[idx] += item["count"]
+
+    items = [(kernel, totals[idx], counts[idx])
+             for kernel, idx in name_to_idx.items()]
+    items.sort(key=operator.itemgetter(1), reverse=True)
+    return [{
+        "kernel": kernel,
+        "total_duration_us": round(total, 3),
+        "count": count,
+        "avg_duration_us": round(total / count, 3)
+    } for kernel, total, count in items]
+
+
 if __name__ == "__main__":
     import sys
+    from multiprocessing import Pool
 
     # 检查命令行参数
-    if len(sys.argv) != 2:
-        print("用法：python kernel_analyzer.py <trace_file.json>")
+    if len(sys.argv) < 2:
+        print("用法：python kernel_analyzer.py <trace_file.json> [更多trace文件 ...]")
         sys.exit(1)
 
-    # 执行分析
-    trace_file = sys.argv[1]
-    results = analyze_kernel_events(trace_file)
+    # 执行分析：单文件直接处理；多文件（如 rank-0..N 的trace）时
+    # 每个文件的解压+解析彼此独立，按进程并行后在父进程归并
+    trace_files = sys.argv[1:]
+    if len(trace_files) == 1:
+        results = analyze_kernel_events(trace_files[0])
+    else:
+        with Pool(processes=min(len(trace_files), os.cpu_count() or 1)) as pool:
+            partials = pool.map(analyze_kernel_events, trace_files)
+        results = merge_kernel_stats(partials)
 
     # 输出结果
     if results:
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import os
+import re
 import subprocess
 import time
 import argparse
@@ -10,8 +11,22 @@ from pathlib import Path
 import psutil
 import threading
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List, Dict, Any, Optional
 
+# orjson 序列化嵌套dict比标准库 json.dump 快数倍，没装时退回标准库
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# msgpack 用于缓存已解析的配置，二进制反序列化比JSON解析快一个量级
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 # 配置日志
 logging.basicConfig(
     level=logging.INFO,
@@ -19,6 +34,18 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 每个测试最多捕获 头部+尾部 各这么多行，报告体积与测试输出量解耦
+_CAPTURE_LINES = 8192
+
+
+def _dumps_jsonl(obj) -> bytes:
+    """把对象序列化为一行 JSON（带换行符），优先走 orjson 的C实现"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+    import json
+    return (json.dumps(obj, ensure_ascii=False) + '\n').encode('utf-8')
+
+
 class ServiceTestSuite:
     """管理一组服务和对应的测试脚本"""
     
@@ -28,8 +55,29 @@ class ServiceTestSuite:
         self.success = False
         self.test_results = {}
         self.log_thread = None
-        self.log_buffer = []
+        # maxlen 让旧日志行以 O(1) 自动淘汰（list.pop(0) 是 O(n) 的）
+        self.log_buffer = deque(maxlen=1000)
         self.service_ready = threading.Event()
+        # 服务stdout走独立logger且不向root传播，避免海量启动日志
+        # 与协调器自身的日志争抢同一个handler锁
+        self.svc_logger = logging.getLogger(f"svc.{config.get('name', 'unknown')}")
+        self.svc_logger.propagate = False
+        if not self.svc_logger.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(message)s'))
+            self.svc_logger.addHandler(handler)
+        # 复用同一个连接做健康检查，省去每次探测的TCP握手
+        self.http_session = requests.Session()
+        # 预编译就绪匹配器：日志线程按 bytes 逐行匹配，普通子串用
+        # bytes.find（C级memmem），带正则元字符的模式编译一次复用
+        ready_pattern = config.get('ready_pattern')
+        if not ready_pattern:
+            self._ready_match = None
+        elif any(ch in ready_pattern for ch in '.^$*+?{}[]|()\\'):
+            self._ready_match = re.compile(ready_pattern.encode('utf-8')).search
+        else:
+            pattern_bytes = ready_pattern.encode('utf-8')
+            self._ready_match = lambda line, p=pattern_bytes: p in line
         
     def start_service(self) -> bool:
         """启动服务"""
@@ -46,7 +94,8 @@ class ServiceTestSuite:
                 stdout=slave,
                 stderr=slave,
                 close_fds=True,
-                universal_newlines=True
+                universal_newlines=True,
+                start_new_session=True  # 独立进程组，停止时可整组发信号
             )
             
             # 关闭从端，主端用于读取
@@ -87,20 +136,40 @@ class ServiceTestSuite:
             return
             
         try:
-            with os.fdopen(master_fd, 'r') as f:
-                for line in iter(f.readline, ''):
-                    line = line.strip()
-                    self.log_buffer.append(line)
-                    logger.info(line)
-                    
-                    # 检查服务就绪模式
-                    ready_pattern = self.config.get('ready_pattern')
-                    if ready_pattern and ready_pattern in line:
-                        self.service_ready.set()
-                        
-                    # 限制缓冲区大小，防止内存溢出
-                    if len(self.log_buffer) > 1000:
-                        self.log_buffer.pop(0)
+            # 按 bytes 读取，就绪匹配直接在 bytes 上进行，解码只为写日志
+            ready_match = self._ready_match  # 提升为局部变量，省去每行属性查找
+            # 级别检查只做一次；INFO被关掉时连LogRecord的格式化都省掉
+            info_enabled = self.svc_logger.isEnabledFor(logging.INFO)
+            svc_info = self.svc_logger.info
+
+            def handle_line(line):
+                self.log_buffer.append(line)
+                if info_enabled:
+                    svc_info(line.decode('utf-8', errors='replace'))
+                # 检查服务就绪模式
+                if ready_match is not None and ready_match(line):
+                    self.service_ready.set()
+
+            # 64KB块读取：系统调用次数从 O(行数) 降到 O(字节数/64KB)，
+            # 换行切分在用户态的 bytearray 上完成
+            buf = bytearray()
+            while True:
+                try:
+                    chunk = os.read(master_fd, 65536)
+                except OSError:
+                    break  # pty 对端关闭后 Linux 上读主端会报 EIO
+                if not chunk:
+                    break
+                buf += chunk
+                nl = buf.find(b'\n')
+                while nl >= 0:
+                    handle_line(bytes(buf[:nl]).strip())
+                    del buf[:nl + 1]
+                    nl = buf.find(b'\n')
+
+            # 处理末尾没有换行符的残留内容
+            if buf:
+                handle_line(bytes(buf).strip())
         except Exception as e:
             logger.error(f"处理服务日志时出错: {e}")
         finally:
@@ -118,18 +187,22 @@ class ServiceTestSuite:
             
         logger.info(f"等待服务 {self.config['name']} 在 {self.config['health_check']} 上就绪...")
         start_time = time.time()
-        
+        delay = 0.1
+
         while time.time() - start_time < self.config.get('timeout', 300):
             try:
-                response = requests.get(self.config['health_check'], timeout=5)
+                response = self.http_session.get(self.config['health_check'], timeout=2)
                 if response.status_code == 200:
                     logger.info(f"服务 {self.config['name']} 已就绪")
                     return True
             except Exception as e:
-                logger.debug(f"服务尚未就绪: {e}")
-                
-            time.sleep(1)  # 更频繁地检查
-            
+                # %-风格延迟格式化：DEBUG关闭时不触发异常的str()
+                logger.debug("服务尚未就绪: %s", e)
+
+            # 指数退避：启动初期高频探测，之后逐步放缓到最多2秒一次
+            time.sleep(delay)
+            delay = min(delay * 1.5, 2.0)
+
         logger.error(f"服务 {self.config['name']} 在超时时间内未就绪")
         return False
     
@@ -144,41 +217,52 @@ class ServiceTestSuite:
         for test_name, test_script in self.config['test_scripts'].items():
             logger.info(f"\n==== 开始执行测试: {self.config['name']} - {test_name} ====")
             
-            # 运行测试脚本
+            # 流式运行测试脚本：输出边执行边写日志，报告里只保留
+            # 头部（启动上下文）+ 尾部（崩溃现场），中间部分丢弃，
+            # 单个测试的捕获量有固定上限，不随子进程输出量增长
+            head = []
+            tail = deque(maxlen=_CAPTURE_LINES)
+            truncated = 0
             try:
-                test_result = subprocess.run(
+                test_proc = subprocess.Popen(
                     test_script,
                     shell=True,
-                    check=False,
-                    capture_output=True,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,  # stderr 合并进 stdout
                     text=True,
-                    # timeout=300  # 设置测试超时时间
+                    bufsize=1
                 )
+                for line in test_proc.stdout:
+                    logger.info(line.rstrip())
+                    if len(head) < _CAPTURE_LINES:
+                        head.append(line)
+                    else:
+                        if len(tail) == _CAPTURE_LINES:
+                            truncated += 1  # 尾部环形缓冲挤掉的行数
+                        tail.append(line)
+                returncode = test_proc.wait()
             except subprocess.TimeoutExpired as e:
                 logger.error(f"测试 {test_name} 超时")
                 return False
-                
-            # 记录测试结果
+
+            captured = head
+            if tail:
+                if truncated:
+                    captured = head + [f"... 中间截断 {truncated} 行 ...\n"] + list(tail)
+                else:
+                    captured = head + list(tail)
+
+            # 记录测试结果（stderr 已合并进 stdout）
             self.test_results[test_name] = {
-                'returncode': test_result.returncode,
-                'stdout': test_result.stdout,
-                'stderr': test_result.stderr,
-                'success': test_result.returncode == 0
+                'returncode': returncode,
+                'stdout': ''.join(captured),
+                'stderr': '',
+                'success': returncode == 0
             }
-            
-            # 输出测试结果
-            logger.info(f"测试 {test_name} 标准输出:")
-            for line in test_result.stdout.splitlines():
-                logger.info(line)
-                
-            if test_result.stderr:
-                logger.warning(f"测试 {test_name} 错误输出:")
-                for line in test_result.stderr.splitlines():
-                    logger.warning(line)
-                
-            logger.info(f"测试 {test_name} 完成，返回代码: {test_result.returncode}")
-            
-            if test_result.returncode != 0:
+
+            logger.info(f"测试 {test_name} 完成，返回代码: {returncode}")
+
+            if returncode != 0:
                 logger.error(f"测试 {test_name} 失败")
                 all_success = False
             else:
@@ -194,26 +278,57 @@ class ServiceTestSuite:
             
         logger.info(f"停止服务: {self.config['name']}")
         
+        try:
+            # 服务启动时已通过 start_new_session 独立成进程组，
+            # 一次 killpg 即可送达整棵进程树，无需遍历 /proc 逐个终止
+            pgid = os.getpgid(self.service_process.pid)
+            os.killpg(pgid, signal.SIGTERM)
+
+            try:
+                self.service_process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                logger.warning(f"服务 {self.config['name']} 未响应终止信号，强制终止进程组")
+                os.killpg(pgid, signal.SIGKILL)
+                self.service_process.wait()
+
+        except ProcessLookupError:
+            # 进程组已不存在，视为已停止
+            pass
+        except Exception as e:
+            # 进程组操作失败时退回 psutil 逐进程终止
+            logger.warning(f"按进程组终止服务 {self.config['name']} 失败（{e}），退回逐进程终止")
+            if not self._stop_service_psutil():
+                return False
+
+        # 等待日志线程完成
+        if self.log_thread and self.log_thread.is_alive():
+            self.log_thread.join(timeout=2.0)
+
+        logger.info(f"服务 {self.config['name']} 已成功停止")
+        return True
+
+    def _stop_service_psutil(self) -> bool:
+        """psutil 回退路径：递归遍历并逐个终止进程树"""
         try:
             # 获取主进程
             main_process = psutil.Process(self.service_process.pid)
-            
+
             # 获取所有子进程（递归）
             children = main_process.children(recursive=True)
-            
+
             # 先终止所有子进程
             for child in children:
                 logger.info(f"终止子进程: {child.pid} ({child.name()})")
                 child.terminate()
-                
+
             # 等待子进程结束
             _, still_alive = psutil.wait_procs(children, timeout=5)
-            
+
             # 强制杀死仍在运行的子进程
             for child in still_alive:
                 logger.warning(f"强制终止子进程: {child.pid} ({child.name()})")
                 child.kill()
-                
+
             # 终止主进程
             self.service_process.terminate()
             try:
@@ -221,14 +336,9 @@ class ServiceTestSuite:
             except subprocess.TimeoutExpired:
                 self.service_process.kill()
                 self.service_process.wait()
-                
-            # 等待日志线程完成
-            if self.log_thread and self.log_thread.is_alive():
-                self.log_thread.join(timeout=2.0)
-                
-            logger.info(f"服务 {self.config['name']} 已成功停止")
+
             return True
-            
+
         except (psutil.NoSuchProcess, psutil.AccessDenied) as e:
             logger.error(f"停止服务 {self.config['name']} 时进程操作错误: {e}")
             return False
@@ -279,9 +389,30 @@ class MultiServiceTester:
             # 简单实现：假设配置文件是 JSON 格式
             # 实际应用中可以支持 YAML 等其他格式
             import json
-            with open(self.config_file, 'r') as f:
-                configs = json.load(f)
-                
+            cache_file = self.config_file + '.cache.mp'
+            configs = None
+
+            if msgpack is not None:
+                # msgpack 旁路缓存：不旧于JSON源文件时直接反序列化，
+                # 参数化扫描反复调起本脚本时可省掉重复的JSON解析
+                try:
+                    if os.path.getmtime(cache_file) >= os.path.getmtime(self.config_file):
+                        with open(cache_file, 'rb') as f:
+                            configs = msgpack.unpackb(f.read(), raw=False)
+                except (OSError, ValueError):
+                    configs = None
+
+            if configs is None:
+                # JSON 始终是配置的唯一事实来源，缓存只是加速副本
+                with open(self.config_file, 'r') as f:
+                    configs = json.load(f)
+                if msgpack is not None:
+                    try:
+                        with open(cache_file, 'wb') as f:
+                            f.write(msgpack.packb(configs))
+                    except OSError:
+                        pass  # 缓存写失败不影响主流程
+
             for config in configs:
                 self.suites.append(ServiceTestSuite(config))
                 
@@ -302,24 +433,52 @@ class MultiServiceTester:
                 
         return all_success
     
-    def run_parallel(self) -> bool:
-        """并行执行所有测试套件"""
-        threads = []
-        
-        for suite in self.suites:
-            thread = threading.Thread(target=suite.run)
-            thread.start()
-            threads.append(thread)
-            
-        # 等待所有线程完成
-        for thread in threads:
-            thread.join()
-            
+    def run_parallel(self, max_workers: Optional[int] = None, fail_fast: bool = False) -> bool:
+        """并行执行所有测试套件
+
+        max_workers 限制同时运行的套件数，避免多个 SGLang 服务同时启动
+        挤爆 GPU/内存；fail_fast 为真时，首个失败后取消尚未开始的套件。
+        """
+        if not max_workers:
+            max_workers = min(len(self.suites), os.cpu_count() or 1)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(suite.run): suite for suite in self.suites}
+            for future in as_completed(futures):
+                if not future.result() and fail_fast:
+                    logger.error(f"套件 {futures[future].config['name']} 失败，取消剩余套件")
+                    for f in futures:
+                        f.cancel()
+                    break
+
         # 检查所有套件是否成功
         return all([suite.success for suite in self.suites])
     
-    def generate_report(self, output_file: str = None):
-        """生成测试报告"""
+    def generate_report(self, output_file: str = None, report_format: str = 'json'):
+        """生成测试报告
+
+        report_format 为 'jsonl' 时按行流式写出（首行为汇总头，之后每个
+        套件一行），峰值内存只有单个套件的记录；'json' 保持单对象格式。
+        """
+        if report_format == 'jsonl' and output_file:
+            try:
+                with open(output_file, 'wb') as f:
+                    f.write(_dumps_jsonl({
+                        'timestamp': time.strftime("%Y-%m-%d %H:%M:%S"),
+                        'total_suites': len(self.suites),
+                        'success_suites': sum([1 for s in self.suites if s.success]),
+                    }))
+                    for suite in self.suites:
+                        f.write(_dumps_jsonl({
+                            'name': suite.config['name'],
+                            'success': suite.success,
+                            'test_results': suite.test_results
+                        }))
+                logger.info(f"测试报告已保存到 {output_file}")
+            except Exception as e:
+                logger.error(f"保存测试报告失败: {e}")
+            return None
+
         report = {
             'timestamp': time.strftime("%Y-%m-%d %H:%M:%S"),
             'total_suites': len(self.suites),
@@ -337,9 +496,13 @@ class MultiServiceTester:
             
         if output_file:
             try:
-                with open(output_file, 'w', encoding='utf-8') as f:
-                    import json
-                    json.dump(report, f, indent=2, ensure_ascii=False)
+                if orjson is not None:
+                    with open(output_file, 'wb') as f:
+                        f.write(orjson.dumps(report, option=orjson.OPT_INDENT_2))
+                else:
+                    with open(output_file, 'w', encoding='utf-8') as f:
+                        import json
+                        json.dump(report, f, indent=2, ensure_ascii=False)
                 logger.info(f"测试报告已保存到 {output_file}")
             except Exception as e:
                 logger.error(f"保存测试报告失败: {e}")
@@ -350,17 +513,21 @@ def main():
     parser = argparse.ArgumentParser(description='SGLang 多服务多测试协调器')
     parser.add_argument('--config', required=True, help='配置文件路径')
     parser.add_argument('--parallel', action='store_true', help='并行执行测试套件')
+    parser.add_argument('--jobs', type=int, default=0, help='并行执行时的最大并发套件数（默认取套件数和CPU核数的较小值）')
+    parser.add_argument('--fail-fast', action='store_true', help='首个套件失败后取消尚未开始的套件')
     parser.add_argument('--report', help='输出测试报告的文件路径')
-    
+    parser.add_argument('--report-format', choices=['json', 'jsonl'], default='json',
+                        help='报告格式：json 为单个对象，jsonl 为每个套件一行的流式格式')
+
     args = parser.parse_args()
-    
+
     tester = MultiServiceTester(args.config)
-    
+
     logger.info(f"开始执行测试，模式: {'并行' if args.parallel else '串行'}")
-    success = tester.run_parallel() if args.parallel else tester.run_serial()
+    success = tester.run_parallel(args.jobs, args.fail_fast) if args.parallel else tester.run_serial()
     
     if args.report:
-        tester.generate_report(args.report)
+        tester.generate_report(args.report, args.report_format)
     
     logger.info(f"所有测试完成，整体结果: {'成功' if success else '失败'}")
     sys.exit(0 if success else 1)
@@ -1,26 +1,77 @@
 #!/usr/bin/env python3
 import os
+import selectors
+import shlex
 import subprocess
 import time
 import argparse
-import requests
 import signal
 import sys
+import threading
 from pathlib import Path
-import psutil
+
+# requests 和 psutil 都比较重（各自连带上百个模块），延迟到真正用到的
+# 方法里再导入，CI包装脚本频繁走的 --help / 参数校验路径不付这笔开销
+
+# SGLang 启动完成的日志标志（按 bytes 匹配，stdout无需逐行解码）
+READY_BANNER = b"The server is fired up and ready to roll"  # 根据实际日志调整
+
+
+def _as_command(cmd):
+    """把命令串转成argv列表，省掉 /bin/sh -c 这层中转进程
+
+    直接exec意味着持有的PID就是真正的子进程（而非shell），
+    进程组信号能立即命中；依赖管道/重定向等shell语法的命令
+    仍交给shell执行。返回 (args, use_shell)。
+    """
+    if any(ch in cmd for ch in "|<>&;$`"):
+        return cmd, True
+    return shlex.split(cmd), False
+
 
 class ServiceTester:
-    def __init__(self, start_script, test_scripts, health_check_url="http://localhost:8102/health", timeout=300):
+    def __init__(self, start_script, test_scripts, health_check_url="http://localhost:8102/health", timeout=300, max_parallel=1, capture=False):
         self.start_script = start_script
         self.test_scripts = test_scripts
         self.health_check_url = health_check_url
         self.timeout = timeout
+        self.max_parallel = max_parallel
+        self.capture = capture
         self.service_process = None
-        
-        # 注册信号处理，确保服务能被正确终止
-        signal.signal(signal.SIGINT, self._signal_handler)
-        signal.signal(signal.SIGTERM, self._signal_handler)
-    
+
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        # 复用同一个HTTP连接做健康检查，省去每次探测的TCP握手和DNS解析。
+        # 连接被拒（服务预热期常态）在urllib3内部带退避地重试几次，
+        # 不必每次都弹回Python层的异常路径；状态码不触发重试，
+        # 服务答复了（即使是500）就立即交回探测循环判断
+        self._session = requests.Session()
+        self._session.mount("http://", HTTPAdapter(
+            pool_connections=1, pool_maxsize=1,
+            max_retries=Retry(total=None, connect=3, read=0, backoff_factor=0.1,
+                              status_forcelist=[])))
+        self._head_ok = True  # /health 是否支持HEAD，首次405后改走GET
+
+        # 子进程退出事件：SIGCHLD到达时由内核即时唤醒停止流程
+        self._child_exited = threading.Event()
+        self._sigchld_enabled = False
+
+        # 注册信号处理，确保服务能被正确终止。
+        # signal.signal 只允许在主线程调用：worker线程里实例化本类时
+        # （如并行CI用线程池驱动多个tester）跳过注册，清理交由调用方
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self._signal_handler)
+            signal.signal(signal.SIGTERM, self._signal_handler)
+            if hasattr(signal, "SIGCHLD"):  # 非POSIX平台退回纯轮询
+                signal.signal(signal.SIGCHLD, self._sigchld_handler)
+                self._sigchld_enabled = True
+
+    def _sigchld_handler(self, signum, frame):
+        """SIGCHLD：有子进程退出，唤醒正在等待的停止流程"""
+        self._child_exited.set()
+
     def _signal_handler(self, signum, frame):
         """处理中断信号，确保服务进程被终止"""
         print(f"收到终止信号 {signum}，正在停止服务...")
@@ -31,75 +82,214 @@ class ServiceTester:
         """启动 SGLang 服务"""
         print(f"启动 SGLang 服务: {self.start_script}")
         
-        # 启动服务脚本作为子进程
+        # 启动服务脚本作为子进程（stdout按二进制读取，不经过io层逐行解码）
+        args, use_shell = _as_command(self.start_script)
         self.service_process = subprocess.Popen(
-            self.start_script,
-            shell=True,
+            args,
+            shell=use_shell,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
-            universal_newlines=True
+            start_new_session=True  # 独立进程组，停止时可整组发信号
         )
-        
-        # 实时输出服务启动日志
+
+        # 实时输出服务启动日志：非阻塞fd + 64KB块读取，
+        # 系统调用次数从每行一次降到每块一次，标志匹配是C级子串查找
         print("服务启动日志:")
-        for line in iter(self.service_process.stdout.readline, ''):
-            print(line, end='')
-            if "The server is fired up and ready to roll" in line:  # 根据实际日志调整
-                print("检测到服务启动完成标志")
-                break
-                
+        fd = self.service_process.stdout.fileno()
+        os.set_blocking(fd, False)
+        sel = selectors.DefaultSelector()
+        sel.register(fd, selectors.EVENT_READ)
+
+        buf = bytearray()
+        found = False
+        # monotonic 不受NTP校时影响（CUDA预热动辄数分钟，期间可能发生校时）
+        deadline = time.monotonic() + self.timeout
+        try:
+            while not found:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    print("等待服务启动标志超时")
+                    break
+                if not sel.select(timeout=remaining):
+                    continue
+                try:
+                    data = os.read(fd, 65536)
+                except BlockingIOError:
+                    continue
+                if not data:
+                    break  # 服务已退出或关闭了stdout
+                sys.stdout.buffer.write(data)
+                sys.stdout.buffer.flush()
+                buf += data
+                # 只扫描新块加上一个标志长度的重叠窗口，
+                # 避免每收一块都从头重扫整个缓冲区
+                scan_from = max(0, len(buf) - len(data) - len(READY_BANNER))
+                if buf.find(READY_BANNER, scan_from) >= 0:
+                    print("检测到服务启动完成标志")
+                    found = True
+        finally:
+            sel.close()
+            os.set_blocking(fd, True)  # 交还给后台排空线程按行阻塞读取
+
+        # 就绪后仍要有人持续排空stdout，否则管道缓冲写满会堵住子进程
+        self._drain_thread = threading.Thread(target=self._drain_service_output,
+                                              daemon=True)
+        self._drain_thread.start()
+
         return self.service_process.poll() is None  # 返回服务是否还在运行
+
+    def _drain_service_output(self):
+        """后台持续排空服务stdout，防止管道缓冲区写满堵塞子进程"""
+        try:
+            for line in iter(self.service_process.stdout.readline, b''):
+                sys.stdout.buffer.write(line)
+        except (ValueError, OSError):
+            pass  # 服务退出或管道已关闭
     
+    def _probe_health(self, timeout):
+        """健康探测：优先HEAD（不生成响应体，预热期为服务端省CPU和流量），
+        端点答405时改用GET并记住结论"""
+        if self._head_ok:
+            response = self._session.head(self.health_check_url, timeout=timeout,
+                                          allow_redirects=False)
+            if response.status_code != 405:
+                return response
+            self._head_ok = False
+        return self._session.get(self.health_check_url, timeout=timeout,
+                                 allow_redirects=False)
+
+    def _confirm_service_ready(self):
+        """启动标志出现后做一次确认探测
+
+        就绪信号已经由启动日志给出，这里只需单次健康检查确认，
+        不必再走整个轮询等待。
+        """
+        try:
+            response = self._probe_health(timeout=2)
+            if response.status_code == 200:
+                print("服务已就绪（启动标志 + 健康检查确认）")
+                return True
+        except Exception as e:
+            print(f"就绪确认失败: {e}，退回HTTP轮询")
+        return False
+
     def wait_for_service_ready(self):
         """等待服务就绪"""
         print(f"等待服务在 {self.health_check_url} 上就绪...")
-        start_time = time.time()
-        
-        while time.time() - start_time < self.timeout:
+        # 截止时间只算一次，循环里各剩一次 monotonic 调用
+        deadline = time.monotonic() + self.timeout
+        delay = 0.05
+
+        while time.monotonic() < deadline:
             try:
-                response = requests.get(self.health_check_url)
+                response = self._probe_health(timeout=1)
                 if response.status_code == 200:
                     print("服务已就绪")
                     return True
             except Exception as e:
                 print(f"服务尚未就绪: {e}，重试中...")
-                
-            time.sleep(5)  # 每隔5秒检查一次
-            
+
+            # 指数退避：起步50ms高频探测，失败后逐步放缓到最多2秒一次
+            time.sleep(delay)
+            delay = min(delay * 2, 2.0)
+
         print(f"服务在 {self.timeout} 秒内未就绪，超时退出")
         return False
     
+    @staticmethod
+    def _pump_stream(src, dst):
+        """把子进程的输出流逐行转发到目标流"""
+        try:
+            for line in iter(src.readline, ''):
+                dst.write(line)
+        except (ValueError, OSError):
+            pass  # 子进程退出或管道已关闭
+
+    def _run_tests_parallel(self):
+        """并发执行测试脚本，整体耗时趋近最慢脚本而非各脚本之和
+
+        注意：要求测试脚本之间相互独立（不抢占端口/结果文件等资源）。
+        并发时输出整段捕获、按完成顺序打印，避免各脚本的输出交错。
+        """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+
+        all_success = True
+        with ThreadPoolExecutor(max_workers=self.max_parallel) as executor:
+            futures = {}
+            for script in self.test_scripts:
+                args, use_shell = _as_command(script)
+                future = executor.submit(subprocess.run, args, shell=use_shell,
+                                         capture_output=True, text=True)
+                futures[future] = script
+            for future in as_completed(futures):
+                script = futures[future]
+                result = future.result()
+                print(f"\n==== 测试完成: {script}，返回代码: {result.returncode} ====")
+                if result.stdout:
+                    print(result.stdout)
+                if result.stderr:
+                    print(result.stderr, file=sys.stderr)
+                if result.returncode != 0:
+                    print(f"警告: 测试 {script} 失败")
+                    all_success = False
+                else:
+                    print(f"测试 {script} 通过")
+
+        return all_success
+
     def run_test(self):
         """运行 benchserving 测试"""
         if not self.service_process or self.service_process.poll() is not None:
             print("服务未运行，无法执行测试")
             return False
-        
+
+        if self.max_parallel > 1:
+            return self._run_tests_parallel()
+
         all_success = True
 
         for test_script in self.test_scripts:
             print(f"\n==== 开始执行测试: {test_script} ====")
-            
-            # 运行测试脚本
-            test_result = subprocess.run(
-                test_script,
-                shell=True,
-                check=False,
-                capture_output=True,
-                text=True
-            )
-            
-            # 输出测试结果
-            print("测试标准输出:")
-            print(test_result.stdout)
-            
-            if test_result.stderr:
-                print("测试错误输出:")
-                print(test_result.stderr)
-                
-            print(f"测试完成，返回代码: {test_result.returncode}")
-            
-            if test_result.returncode != 0:
+
+            args, use_shell = _as_command(test_script)
+            if self.capture:
+                # 流式转发测试输出：边执行边打印，内存占用O(1)，
+                # 不再把整个stdout/stderr缓冲到测试结束后一次性输出
+                test_proc = subprocess.Popen(
+                    args,
+                    shell=use_shell,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    text=True,
+                    bufsize=1
+                )
+                pumps = [
+                    threading.Thread(target=self._pump_stream,
+                                     args=(test_proc.stdout, sys.stdout), daemon=True),
+                    threading.Thread(target=self._pump_stream,
+                                     args=(test_proc.stderr, sys.stderr), daemon=True),
+                ]
+                for pump in pumps:
+                    pump.start()
+                returncode = test_proc.wait()
+                for pump in pumps:
+                    pump.join(timeout=5)
+            else:
+                # 默认让子进程直接继承我们的stdout/stderr文件描述符：
+                # 输出由内核直达终端，Python完全不经手这些字节
+                # （逐token刷屏的benchmark可省掉一整份用户态拷贝）
+                test_proc = subprocess.Popen(
+                    args,
+                    shell=use_shell,
+                    stdout=sys.stdout.fileno(),
+                    stderr=sys.stderr.fileno(),
+                    start_new_session=True
+                )
+                returncode = test_proc.wait()
+
+            print(f"测试完成，返回代码: {returncode}")
+
+            if returncode != 0:
                 print(f"警告: 测试 {test_script} 失败")
                 all_success = False
             else:
@@ -107,51 +297,133 @@ class ServiceTester:
                 
         return all_success
     
+    def __del__(self):
+        # 兜底释放HTTP连接池（正常路径在 stop_service 里已关闭）
+        try:
+            self._session.close()
+        except Exception:
+            pass
+
     def stop_service(self):
         """终止整个进程树（包括所有子进程）"""
+        # 停止服务后不会再探测健康状态，顺手释放HTTP连接池
+        self._session.close()
+
         if self.service_process and self.service_process.poll() is None:
             print("终止 SGLang 服务及所有子进程...")
-            
+
             try:
-                # 获取主进程对象
-                main_proc = psutil.Process(self.service_process.pid)
-                
-                # 递归获取所有子进程（包括孙子进程）
-                all_procs = main_proc.children(recursive=True)
-                all_procs.append(main_proc)  # 包含主进程本身
-                
-                # 先尝试优雅终止（SIGTERM）
-                for proc in all_procs:
+                # 服务启动时已通过 start_new_session 独立成进程组，
+                # 一次 killpg 即可送达整棵进程树，无需遍历 /proc 逐个终止
+                pgid = os.getpgid(self.service_process.pid)
+                os.killpg(pgid, signal.SIGTERM)
+
+                # 优雅等待最多2秒（20ms一跳，进程实际退多快就等多快）；
+                # SGLang/CUDA 很少能从更长的宽限期获益，未退就直接SIGKILL
+                if not self._wait_process_group(pgid):
+                    print("进程组未响应终止信号，强制终止")
                     try:
-                        proc.terminate()
-                        print(f"已向进程 {proc.pid} 发送终止信号")
-                    except psutil.NoSuchProcess:
-                        print(f"进程 {proc.pid} 已终止")
-                
-                # 等待 10 秒，未终止则强制 kill（SIGKILL）
-                gone, alive = psutil.wait_procs(all_procs, timeout=10)
-                
-                if alive:
-                    print(f"以下进程未响应终止信号，强制终止：{[p.pid for p in alive]}")
-                    for proc in alive:
-                        try:
-                            proc.kill()
-                            print(f"已强制终止进程 {proc.pid}")
-                        except psutil.NoSuchProcess:
-                            pass
-                
+                        os.killpg(pgid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                self.service_process.wait()
+
                 print("服务及所有子进程已终止")
                 return True
-                
-            except psutil.NoSuchProcess:
-                print("主进程已不存在，可能已终止")
+
+            except ProcessLookupError:
+                print("进程组已不存在，可能已终止")
                 return True
             except Exception as e:
-                print(f"终止进程树失败：{e}")
-                return False
+                print(f"按进程组终止失败（{e}），退回psutil逐进程终止")
+                return self._stop_service_psutil()
         else:
             print("服务未运行或已终止")
             return True
+
+    def _wait_process_group(self, pgid, grace_s=2.0):
+        """等待进程组退出：SIGCHLD事件驱动，非POSIX平台退化为20ms轮询
+
+        非阻塞收割（WNOHANG）直到ECHILD；期间的等待由SIGCHLD在子进程
+        退出的瞬间唤醒，观测到的停机延迟跟随进程的实际退出时间。
+        """
+        deadline = time.monotonic() + grace_s
+        while True:
+            try:
+                pid, _ = os.waitpid(-pgid, os.WNOHANG)
+            except ChildProcessError:
+                return True  # 组内已无可回收的子进程
+            if pid > 0:
+                continue  # 刚回收一个，立即继续收割
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            # 有SIGCHLD时大步等事件（退出瞬间即被唤醒），否则小步轮询兜底
+            tick = 0.25 if self._sigchld_enabled else 0.02
+            self._child_exited.wait(min(tick, remaining))
+            self._child_exited.clear()
+
+    def _stop_service_psutil(self):
+        """psutil 回退路径：递归遍历并逐个终止进程树"""
+        import psutil
+
+        try:
+            # 获取主进程对象
+            main_proc = psutil.Process(self.service_process.pid)
+
+            # 只做一次 /proc 快照；父→子映射用快照对象上已缓存的 ppid
+            # 构建，不再触发新的 /proc 扫描
+            children = main_proc.children(recursive=True)
+            by_ppid = {}
+            for proc in children:
+                try:
+                    by_ppid.setdefault(proc.ppid(), []).append(proc)
+                except psutil.NoSuchProcess:
+                    pass
+
+            # 从根开始逐层BFS再反序，得到叶子优先的终止顺序
+            # （先停worker再停父进程，避免父进程反复拉起已终止的子进程）
+            levels = []
+            frontier = [main_proc]
+            while frontier:
+                levels.append(frontier)
+                next_frontier = []
+                for proc in frontier:
+                    next_frontier.extend(by_ppid.get(proc.pid, []))
+                frontier = next_frontier
+
+            all_procs = [proc for level in reversed(levels) for proc in level]
+
+            # 先尝试优雅终止（SIGTERM）
+            for proc in all_procs:
+                try:
+                    proc.terminate()
+                    print(f"已向进程 {proc.pid} 发送终止信号")
+                except psutil.NoSuchProcess:
+                    print(f"进程 {proc.pid} 已终止")
+
+            # 等待 10 秒，未终止则强制 kill（SIGKILL）
+            gone, alive = psutil.wait_procs(all_procs, timeout=10)
+
+            if alive:
+                print(f"以下进程未响应终止信号，强制终止：{[p.pid for p in alive]}")
+                for proc in alive:
+                    try:
+                        proc.kill()
+                        print(f"已强制终止进程 {proc.pid}")
+                    except psutil.NoSuchProcess:
+                        pass
+
+            print("服务及所有子进程已终止")
+            return True
+
+        except psutil.NoSuchProcess:
+            print("主进程已不存在，可能已终止")
+            return True
+        except Exception as e:
+            print(f"终止进程树失败：{e}")
+            return False
     
     def run(self):
         """执行完整测试流程"""
@@ -162,8 +434,9 @@ class ServiceTester:
                 print("服务启动失败")
                 return False
                 
-            # 等待服务就绪
-            service_ready = self.wait_for_service_ready()
+            # 等待服务就绪：启动日志已给出就绪信号，通常一次确认探测即可，
+            # 确认失败时才退回HTTP轮询
+            service_ready = self._confirm_service_ready() or self.wait_for_service_ready()
             if not service_ready:
                 self.stop_service()
                 return False
@@ -188,14 +461,20 @@ def main():
     parser.add_argument('--test-scripts', nargs='+', required=True, help='执行测试的脚本列表，用空格分隔')
     parser.add_argument('--health-url', default='http://localhost:30000/health', help='服务健康检查 URL')
     parser.add_argument('--timeout', type=int, default=300, help='服务启动超时时间（秒）')
-    
+    parser.add_argument('--max-parallel', type=int, default=1,
+                        help='并发执行的测试脚本数（要求脚本相互独立，默认1即串行）')
+    parser.add_argument('--capture', action='store_true',
+                        help='经由Python转发测试输出；默认子进程直接写终端，开销更低')
+
     args = parser.parse_args()
-    
+
     tester = ServiceTester(
         start_script=args.start_script,
         test_scripts=args.test_scripts,
         health_check_url=args.health_url,
-        timeout=args.timeout
+        timeout=args.timeout,
+        max_parallel=args.max_parallel,
+        capture=args.capture
     )
     
     success = tester.run()